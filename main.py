@@ -4,37 +4,74 @@ from OpenGL.GL.shaders import compileShader, compileProgram
 import numpy as np
 import glm
 import ctypes
-import time
 
 vertex_shader_source = """
-#version 330 core
-layout(location = 0) in vec3 aPos;
-layout(location = 1) in vec2 aTexCoord;
-out vec2 TexCoord;
-out vec3 TexCoord3D;
-uniform mat4 model;
-uniform mat4 view;
-uniform mat4 projection;
-uniform float slice;
+#version 420 core
+out vec2 ndcPos;
 void main() {
-    vec3 pos = aPos;
-    pos.z = slice * 2.0 - 1.0; // Map slice [0, 1] to [-1, 1] in NDC
-    gl_Position = projection * view * model * vec4(pos, 1.0);
-    TexCoord = vec2(aTexCoord.x, 1.0 - aTexCoord.y); // Flip Y coordinate
-    TexCoord3D = vec3(aTexCoord.x, 1.0 - aTexCoord.y, slice); // Flip Y coordinate
+    // Fullscreen triangle generated from gl_VertexID: (-1, -1), (3, -1), (-1, 3)
+    vec2 pos = vec2(float((gl_VertexID << 1) & 2), float(gl_VertexID & 2)) * 2.0 - 1.0;
+    ndcPos = pos;
+    gl_Position = vec4(pos, 0.0, 1.0);
 }
 """
 
 fragment_shader_source = """
-#version 330 core
+#version 420 core
 out vec4 FragColor;
-in vec2 TexCoord;
-in vec3 TexCoord3D;
-uniform sampler3D texture1;
+in vec2 ndcPos;
+layout(std140, binding = 0) uniform RayParams {
+    mat4 inverseMVP;
+    vec3 volumeBounds; // Half extents of the volume box in model space
+    float stepSize;
+};
+layout(binding = 0) uniform sampler3D texture1;
+layout(binding = 1) uniform sampler1D tfTex;
+const int MAX_STEPS = 512;
+const vec3 backgroundColor = vec3(1.0, 1.0, 1.0);
+uint wang_hash(uint s) {
+    s = (s ^ 61u) ^ (s >> 16u);
+    s *= 9u;
+    s ^= s >> 4u;
+    s *= 0x27d4eb2du;
+    s ^= s >> 15u;
+    return s;
+}
 void main() {
-    float intensity = texture(texture1, TexCoord3D).r;
-    FragColor = vec4(intensity, intensity, intensity, intensity * 0.4); // Adjust alpha for better visibility
-    if (FragColor.a < 0.01) discard;
+    // Unproject the pixel on the near and far planes to get the ray in model space
+    vec4 nearPos = inverseMVP * vec4(ndcPos, -1.0, 1.0);
+    vec4 farPos = inverseMVP * vec4(ndcPos, 1.0, 1.0);
+    vec3 rayOrigin = nearPos.xyz / nearPos.w;
+    vec3 rayDir = normalize(farPos.xyz / farPos.w - rayOrigin);
+
+    // Slab test against the volume box
+    vec3 invDir = 1.0 / rayDir;
+    vec3 t0 = (-volumeBounds - rayOrigin) * invDir;
+    vec3 t1 = (volumeBounds - rayOrigin) * invDir;
+    vec3 tNear = min(t0, t1);
+    vec3 tFar = max(t0, t1);
+    float tEnter = max(max(tNear.x, tNear.y), max(tNear.z, 0.0));
+    float tExit = min(min(tFar.x, tFar.y), tFar.z);
+
+    // Per-pixel jitter of the ray start hides wood-grain artifacts
+    float jitter = float(wang_hash(uint(gl_FragCoord.x) + uint(gl_FragCoord.y) * 1920u)) * (1.0 / 4294967296.0);
+    float tStart = tEnter + jitter * stepSize;
+
+    // Move the ray into texture space once, folding in the [-bounds, bounds] -> [0, 1] mapping and the Y flip
+    vec3 texScale = vec3(0.5, -0.5, 0.5) / volumeBounds;
+    vec3 texOrigin = rayOrigin * texScale + 0.5;
+    vec3 texDir = rayDir * texScale;
+
+    vec4 accum = vec4(0.0);
+    for (int i = 0; i < MAX_STEPS; i++) {
+        float t = tStart + float(i) * stepSize;
+        if (t > tExit) break;
+        float intensity = texture(texture1, texOrigin + texDir * t).r;
+        vec4 sampleColor = texture(tfTex, intensity * (255.0 / 256.0) + 0.5 / 256.0); // Sample at texel centers
+        accum += (1.0 - accum.a) * sampleColor; // Front-to-back compositing, colors are premultiplied
+        if (accum.a > 0.95) break; // Early ray termination
+    }
+    FragColor = vec4(accum.rgb + (1.0 - accum.a) * backgroundColor, 1.0);
 }
 """
 
@@ -45,17 +82,73 @@ slices_width = 256
 slices_height = 256
 num_slices = 128
 
+# Samples taken across the depth of the volume along each ray; jittered ray starts keep
+# quality with fewer samples than the data has slices
+num_samples = 64
+
+# Sample count the transfer function opacities are tuned for
+tf_reference_samples = 128
+
+# Uniform buffer binding point of the RayParams block, must match its layout(binding) in the shader
+ray_params_binding = 0
+
+# std140 layout of RayParams; the vec3 packs with the following float, so no padding is needed
+ray_params_dtype = np.dtype([
+    ("inverseMVP", np.float32, (4, 4)),
+    ("volumeBounds", np.float32, 3),
+    ("stepSize", np.float32),
+])
+
+# Whether the current context supports glBufferStorage, detected once after context creation
+buffer_storage_supported = False
+
+# Camera matrices, rebuilt from the input callbacks
+view_matrix = glm.mat4(1.0)
+projection_matrix = glm.mat4(1.0)
+_camera_dirty = True
+
 
-def load_data_from_file(file_name):
+def load_data_from_file(file_name, count, dtype=np.uint8):
+    # Read straight into a preallocated array to avoid an intermediate bytes copy
+    data = np.empty(count, dtype=dtype)
     with open(file_name, 'rb') as file:
-        data = np.fromfile(file, dtype=np.float32)
+        bytes_read = file.readinto(data)
+    if bytes_read != data.nbytes:
+        raise ValueError(f"{file_name}: expected {data.nbytes} bytes of volume data, read {bytes_read}")
     return data
 
 
+def detect_buffer_storage():
+    # Entry points can resolve even when unsupported (e.g. on GLX), so check the context's version and extensions
+    if (glGetIntegerv(GL_MAJOR_VERSION), glGetIntegerv(GL_MINOR_VERSION)) >= (4, 4):
+        return True
+    return any(glGetStringi(GL_EXTENSIONS, i) == b"GL_ARB_buffer_storage"
+               for i in range(glGetIntegerv(GL_NUM_EXTENSIONS)))
+
+
+def allocate_buffer(target, size, storage_flags, usage):
+    # Prefer immutable storage (GL 4.4 or ARB_buffer_storage) so the driver can place the buffer optimally
+    if buffer_storage_supported:
+        glBufferStorage(target, size, None, storage_flags)
+    else:
+        glBufferData(target, size, None, usage)
+
+
 def load_3d_texture(data, width, height, depth):
+    # Stage the volume in a pixel unpack buffer so the driver can DMA it into the texture
+    pbo = glGenBuffers(1)
+    glBindBuffer(GL_PIXEL_UNPACK_BUFFER, pbo)
+    allocate_buffer(GL_PIXEL_UNPACK_BUFFER, data.nbytes, GL_MAP_WRITE_BIT, GL_STREAM_DRAW)
+    ptr = glMapBufferRange(GL_PIXEL_UNPACK_BUFFER, 0, data.nbytes, GL_MAP_WRITE_BIT | GL_MAP_INVALIDATE_BUFFER_BIT)
+    ctypes.memmove(ptr, data.ctypes.data, data.nbytes)
+    glUnmapBuffer(GL_PIXEL_UNPACK_BUFFER)
+
     texture_id = glGenTextures(1)
     glBindTexture(GL_TEXTURE_3D, texture_id)
-    glTexImage3D(GL_TEXTURE_3D, 0, GL_R32F, width, height, depth, 0, GL_RED, GL_FLOAT, data)
+    # With a pixel unpack buffer bound, a null data pointer means "read from the buffer at offset 0"
+    glTexImage3D(GL_TEXTURE_3D, 0, GL_R8, width, height, depth, 0, GL_RED, GL_UNSIGNED_BYTE, None)
+    glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+    glDeleteBuffers(1, pbo)
     glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
     glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
     glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
@@ -65,6 +158,45 @@ def load_3d_texture(data, width, height, depth):
     return texture_id
 
 
+def create_transfer_function_texture(sample_spacing, reference_spacing):
+    values = np.arange(256, dtype=np.float32) / 255.0
+    alpha = values * 0.4  # Adjust alpha for better visibility
+    # Opacity correction so the volume looks the same whatever the sample spacing
+    alpha = 1.0 - np.power(1.0 - alpha, sample_spacing / reference_spacing)
+    # Near-transparent samples are zeroed here so they add nothing without a branch in the ray loop
+    alpha[alpha < 0.01] = 0.0
+
+    # Colors are premultiplied by alpha for front-to-back blending
+    lut = np.empty((256, 4), dtype=np.uint8)
+    lut[:, :3] = np.round(values * alpha * 255.0)[:, np.newaxis]
+    lut[:, 3] = np.round(alpha * 255.0)
+
+    texture_id = glGenTextures(1)
+    glBindTexture(GL_TEXTURE_1D, texture_id)
+    glTexImage1D(GL_TEXTURE_1D, 0, GL_RGBA8, 256, 0, GL_RGBA, GL_UNSIGNED_BYTE, lut)
+    glTexParameteri(GL_TEXTURE_1D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+    glTexParameteri(GL_TEXTURE_1D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+    glTexParameteri(GL_TEXTURE_1D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+    glBindTexture(GL_TEXTURE_1D, 0)
+    return texture_id
+
+
+def create_ray_params_buffer(volume_bounds, step_size):
+    ray_params = np.zeros(1, dtype=ray_params_dtype)
+    ray_params["volumeBounds"] = volume_bounds
+    ray_params["stepSize"] = step_size
+    # PyOpenGL has no GL type for structured arrays, so upload the record as plain floats
+    ray_params = ray_params.view(np.float32)
+
+    buffer_id = glGenBuffers(1)
+    glBindBuffer(GL_UNIFORM_BUFFER, buffer_id)
+    allocate_buffer(GL_UNIFORM_BUFFER, ray_params.nbytes, GL_DYNAMIC_STORAGE_BIT, GL_DYNAMIC_DRAW)
+    glBufferSubData(GL_UNIFORM_BUFFER, 0, ray_params.nbytes, ray_params)
+    glBindBuffer(GL_UNIFORM_BUFFER, 0)
+    glBindBufferBase(GL_UNIFORM_BUFFER, ray_params_binding, buffer_id)
+    return buffer_id
+
+
 def create_shader(shader_type, source):
     shader = glCreateShader(shader_type)
     glShaderSource(shader, source)
@@ -90,35 +222,52 @@ def create_shader_program():
     return shader_program
 
 
-def render_slices(texture, shader_program, vao, model, view, projection, num_slices):
-    glUseProgram(shader_program)
+def gl_matrix(matrix):
+    # numpy sees glm matrices in row-major order; GL and std140 expect glm.value_ptr's column-major order
+    return np.ascontiguousarray(np.array(matrix, dtype=np.float32).T)
 
-    model_loc = glGetUniformLocation(shader_program, "model")
-    view_loc = glGetUniformLocation(shader_program, "view")
-    projection_loc = glGetUniformLocation(shader_program, "projection")
-    slice_loc = glGetUniformLocation(shader_program, "slice")
 
-    glUniformMatrix4fv(view_loc, 1, GL_FALSE, glm.value_ptr(view))
-    glUniformMatrix4fv(projection_loc, 1, GL_FALSE, glm.value_ptr(projection))
-    glUniformMatrix4fv(model_loc, 1, GL_FALSE, glm.value_ptr(model))
+def update_view_matrix():
+    global view_matrix, _camera_dirty
+    view_matrix = glm.lookAt(glm.vec3(0.0, 0.0, zoom), glm.vec3(0.0, 0.0, 0.0), glm.vec3(0.0, 1.0, 0.0))
+    _camera_dirty = True
 
-    glEnable(GL_DEPTH_TEST)
-    glDepthMask(GL_FALSE)
-    glEnable(GL_BLEND)
-    glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
 
-    glBindTexture(GL_TEXTURE_3D, texture)
-    glBindVertexArray(vao)
+def update_projection_matrix(width, height):
+    global projection_matrix, _camera_dirty
+    projection_matrix = glm.perspective(glm.radians(45.0), width / height, 0.1, 100.0)
+    _camera_dirty = True
 
-    for i in range(num_slices - 1, -1, -1):
-        slice_val = i / (num_slices - 1)
-        glUniform1f(slice_loc, slice_val)
-        glDrawArrays(GL_TRIANGLE_STRIP, 0, 4)
 
-    glDisable(GL_BLEND)
-    glDepthMask(GL_TRUE)
-    glDisable(GL_DEPTH_TEST)
-    glBindVertexArray(0)
+def qmul(a, b):
+    aw, ax, ay, az = a
+    bw, bx, by, bz = b
+    return np.array([
+        aw * bw - ax * bx - ay * by - az * bz,
+        aw * bx + ax * bw + ay * bz - az * by,
+        aw * by - ax * bz + ay * bw + az * bx,
+        aw * bz + ax * by - ay * bx + az * bw,
+    ], dtype=np.float32)
+
+
+def update_camera_uniforms(ray_params_buffer):
+    global _camera_dirty
+    if not _camera_dirty:
+        return
+
+    # The rotation quaternion is only turned into a matrix here, once per uploaded frame
+    model_matrix = glm.mat4_cast(glm.quat(*rotation.tolist()))
+    # The raycaster only needs the inverse of the combined transform to build rays in model space
+    inverse_mvp = gl_matrix(glm.inverse(projection_matrix * view_matrix * model_matrix))
+    glBindBuffer(GL_UNIFORM_BUFFER, ray_params_buffer)
+    glBufferSubData(GL_UNIFORM_BUFFER, ray_params_dtype.fields["inverseMVP"][1], inverse_mvp.nbytes, inverse_mvp)
+    glBindBuffer(GL_UNIFORM_BUFFER, 0)
+    _camera_dirty = False
+
+
+def render_volume():
+    # The program, textures and VAO are bound once at startup and stay bound
+    glDrawArrays(GL_TRIANGLES, 0, 3)
 
 
 def mouse_button_callback(window, button, action, mods):
@@ -137,27 +286,31 @@ def key_callback(window, key, scancode, action, mods):
 
 
 def mouse_callback(window, xpos, ypos):
-    global last_mouse_pos, first_mouse, rotation
+    global last_mouse_pos, first_mouse, rotation, _camera_dirty
 
     if not mouse_pressed:
         return
 
-    current_mouse_pos = glm.vec2(xpos, ypos)
-
     if first_mouse:
-        last_mouse_pos = current_mouse_pos
+        last_mouse_pos = (xpos, ypos)
         first_mouse = False
         return
 
-    mouse_delta = current_mouse_pos - last_mouse_pos
-    last_mouse_pos = current_mouse_pos
+    delta_x = xpos - last_mouse_pos[0]
+    delta_y = ypos - last_mouse_pos[1]
+    last_mouse_pos = (xpos, ypos)
 
+    # Yaw about Y followed by pitch about X, as one quaternion in (w, x, y, z) order
     rotation_speed = 0.005
-    yaw_quat = glm.angleAxis(mouse_delta.x * rotation_speed, glm.vec3(0.0, 1.0, 0.0))
-    pitch_quat = glm.angleAxis(mouse_delta.y * rotation_speed, glm.vec3(1.0, 0.0, 0.0))
+    half_yaw = delta_x * rotation_speed * 0.5
+    half_pitch = delta_y * rotation_speed * 0.5
+    cy, sy = np.cos(half_yaw), np.sin(half_yaw)
+    cp, sp = np.cos(half_pitch), np.sin(half_pitch)
+    yaw_pitch_quat = (cy * cp, cy * sp, sy * cp, -sy * sp)
 
-    rotation = yaw_quat * pitch_quat * rotation
-    rotation = glm.normalize(rotation)
+    rotation = qmul(yaw_pitch_quat, rotation)
+    rotation /= np.linalg.norm(rotation)
+    _camera_dirty = True
 
 
 def scroll_callback(window, xoffset, yoffset):
@@ -165,20 +318,33 @@ def scroll_callback(window, xoffset, yoffset):
     zoom_sensitivity = 0.1
     zoom -= yoffset * zoom_sensitivity
     zoom = glm.clamp(zoom, 0.5, 5.0)
+    update_view_matrix()
+
+
+def framebuffer_size_callback(window, width, height):
+    glViewport(0, 0, width, height)
+    # A minimized window reports a zero-sized framebuffer
+    if width > 0 and height > 0:
+        update_projection_matrix(width, height)
 
 
 def main():
-    global mouse_pressed, first_mouse, last_mouse_pos, rotation, zoom
+    global mouse_pressed, first_mouse, last_mouse_pos, rotation, zoom, buffer_storage_supported
     mouse_pressed = False
     first_mouse = True
-    last_mouse_pos = glm.vec2(slices_width / 2.0, slices_height / 2.0)
-    rotation = glm.quat(1.0, 0.0, 0.0, 0.0)
+    last_mouse_pos = (slices_width / 2.0, slices_height / 2.0)
+    rotation = np.array([1.0, 0.0, 0.0, 0.0], dtype=np.float32)
     zoom = 3.75
 
     if not glfw.init():
         print("Failed to initialize GLFW")
         return
 
+    # The shaders use GLSL 4.20 layout(binding) qualifiers
+    glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, 4)
+    glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, 2)
+    glfw.window_hint(glfw.OPENGL_PROFILE, glfw.OPENGL_CORE_PROFILE)
+
     window = glfw.create_window(window_width, window_height, "3D Volume Viewer Prototype", None, None)
     if not window:
         print("Failed to create GLFW window")
@@ -186,76 +352,59 @@ def main():
         return
 
     glfw.make_context_current(window)
+    buffer_storage_supported = detect_buffer_storage()
+    # Let swap_buffers block on the display refresh instead of pacing frames by hand
+    glfw.swap_interval(1)
     glfw.set_key_callback(window, key_callback)
     glfw.set_cursor_pos_callback(window, mouse_callback)
     glfw.set_mouse_button_callback(window, mouse_button_callback)
     glfw.set_scroll_callback(window, scroll_callback)
-
-    # Generate random floating-point values for the 3D texture
-    with open("./engine_256x256x128_uint8.raw", 'rb') as file:
-        binary_data = file.read()
-        file.close()
-
-    data = np.frombuffer(binary_data, dtype=np.uint8)
+    glfw.set_framebuffer_size_callback(window, framebuffer_size_callback)
 
     # Load data and texture
+    data = load_data_from_file("./engine_256x256x128_uint8.raw", slices_width * slices_height * num_slices)
     texture_id = load_3d_texture(data, slices_width, slices_height, num_slices)
+    # The volume box spans [-1, 1] on every axis in model space
+    step_size = 2.0 / (num_samples - 1)
+    transfer_function_id = create_transfer_function_texture(step_size, 2.0 / (tf_reference_samples - 1))
+    ray_params_buffer = create_ray_params_buffer((1.0, 1.0, 1.0), step_size)
     shader_program = create_shader_program()
 
-    vertices = np.array([
-        1.0, 1.0, 0.0, 1.0, 1.0,
-        1.0, -1.0, 0.0, 1.0, 0.0,
-        -1.0, 1.0, 0.0, 0.0, 1.0,
-        -1.0, -1.0, 0.0, 0.0, 0.0
-    ], dtype=np.float32)
+    # Sampler units and the uniform block binding are fixed in the shaders with layout(binding)
+    glUseProgram(shader_program)
 
-    vao = glGenVertexArrays(1)
-    vbo = glGenBuffers(1)
+    glActiveTexture(GL_TEXTURE1)
+    glBindTexture(GL_TEXTURE_1D, transfer_function_id)
+    glActiveTexture(GL_TEXTURE0)
+    glBindTexture(GL_TEXTURE_3D, texture_id)
 
+    # Core profiles still require a bound VAO to draw, even with no vertex attributes
+    vao = glGenVertexArrays(1)
     glBindVertexArray(vao)
-    glBindBuffer(GL_ARRAY_BUFFER, vbo)
-    glBufferData(GL_ARRAY_BUFFER, vertices.nbytes, vertices, GL_STATIC_DRAW)
-
-    glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, 5 * ctypes.sizeof(ctypes.c_float), ctypes.c_void_p(0))
-    glEnableVertexAttribArray(0)
-    glVertexAttribPointer(1, 2, GL_FLOAT, GL_FALSE, 5 * ctypes.sizeof(ctypes.c_float),
-                          ctypes.c_void_p(3 * ctypes.sizeof(ctypes.c_float)))
-    glEnableVertexAttribArray(1)
-
-    glBindBuffer(GL_ARRAY_BUFFER, 0)
-    glBindVertexArray(0)
 
-    glEnable(GL_DEPTH_TEST)
+    # The raycaster composites in the shader and writes every pixel, so this state is set once
+    glDisable(GL_DEPTH_TEST)
+    glDepthMask(GL_FALSE)
+    glDisable(GL_BLEND)
+    glClearColor(1.0, 1.0, 1.0, 1.0)
 
-    target_fps = 60.0
-    target_frame_time = 1.0 / target_fps
-    last_frame_time = time.time()
+    update_view_matrix()
+    update_projection_matrix(*glfw.get_framebuffer_size(window))
 
     while not glfw.window_should_close(window):
-        current_frame_time = time.time()
-        delta_time = current_frame_time - last_frame_time
-
-        if delta_time >= target_frame_time:
-            last_frame_time = current_frame_time
-
-            glClearColor(1.0, 1.0, 1.0, 1.0)
-            glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-
-            view = glm.lookAt(glm.vec3(0.0, 0.0, zoom), glm.vec3(0.0, 0.0, 0.0), glm.vec3(0.0, 1.0, 0.0))
-            projection = glm.perspective(glm.radians(45.0), window_width / window_height, 0.1, 100.0)
-            model = glm.mat4_cast(rotation)
+        glClear(GL_COLOR_BUFFER_BIT)
 
-            render_slices(texture_id, shader_program, vao, model, view, projection, num_slices)
+        update_camera_uniforms(ray_params_buffer)
+        render_volume()
 
-            glfw.swap_buffers(window)
-            glfw.poll_events()
-        else:
-            time.sleep(0.001)
+        glfw.swap_buffers(window)
+        glfw.poll_events()
 
     glDeleteVertexArrays(1, vao)
-    glDeleteBuffers(1, vbo)
+    glDeleteBuffers(1, ray_params_buffer)
     glDeleteProgram(shader_program)
     glDeleteTextures(1, texture_id)
+    glDeleteTextures(1, transfer_function_id)
 
     glfw.destroy_window(window)
     glfw.terminate()